@@ -1,6 +1,8 @@
 import csv
 import logging
+from bisect import bisect_left, insort
 from collections import Counter
+from functools import lru_cache
 from statistics import mean
 
 from load_data import load_final_participants, Person
@@ -27,6 +29,10 @@ SWAP_CHAIN_SEARCH_DEPTH = 3
 PEOPLE: list[Person]
 UNASSIGNED: set[Person]
 TEAMS: list[list[Person]]
+# Sorted timezones of each team, parallel to TEAMS, so spans can be checked without re-sorting.
+TEAM_TZS: list[list[float]]
+# Total experience of each team, parallel to TEAMS.
+TEAM_EXP_SUMS: list[int]
 EXP_AVG: float
 
 
@@ -34,10 +40,62 @@ def tz_span(*tzs: tuple[float]) -> float:
     """
     Size of minimum window in which all the timezones fit.
     """
-    tzs = sorted(tz%24 for tz in tzs)
-    gaps = [b-a for a,b in zip(tzs, tzs[1:])]
-    gaps.append(tzs[0] - tzs[-1] + 24)
-    return 24 - max(gaps)
+    return tz_span_sorted(sorted([tz%24 for tz in tzs]))
+
+
+def tz_span_sorted(tzs: list[float]) -> float:
+    """
+    Same as tz_span, for timezones that are already sorted and normalized to 0-24.
+    Teams are small, so skipping the sort matters more than how the sort is done.
+    """
+    max_gap = tzs[0] - tzs[-1] + 24
+    for i in range(1, len(tzs)):
+        if tzs[i] - tzs[i-1] > max_gap:
+            max_gap = tzs[i] - tzs[i-1]
+    return 24 - max_gap
+
+
+def tz_span_with(sorted_tzs: list[float], new_tz: float) -> float:
+    """
+    Same as tz_span(*sorted_tzs, new_tz), but takes advantage of sorted_tzs already being sorted.
+    The new timezone splits one gap in two, and the rest of the gaps are unchanged.
+    All timezones must already be normalized to 0-24, as Person.tz is.
+    """
+    n = len(sorted_tzs)
+    i = bisect_left(sorted_tzs, new_tz)
+    if i == 0:
+        max_gap = max(sorted_tzs[0] - new_tz, new_tz - sorted_tzs[-1] + 24)
+    elif i == n:
+        max_gap = max(new_tz - sorted_tzs[-1], sorted_tzs[0] - new_tz + 24)
+    else:
+        max_gap = max(new_tz - sorted_tzs[i-1], sorted_tzs[i] - new_tz, sorted_tzs[0] - sorted_tzs[-1] + 24)
+    for j in range(1, n):
+        if j != i and sorted_tzs[j] - sorted_tzs[j-1] > max_gap:
+            max_gap = sorted_tzs[j] - sorted_tzs[j-1]
+    return 24 - max_gap
+
+
+# find_swap sees the same target teams over and over as it recurses through the same from-teams.
+# Keyed on the timezones themselves, so entries never go stale as teams change.
+tz_span_with_cached = lru_cache(maxsize=8192)(tz_span_with)
+
+
+def tz_span_without(sorted_tzs: list[float], tz: float) -> float:
+    """
+    Same as tz_span_sorted for sorted_tzs with one instance of tz removed.
+    The two gaps on either side of the removed timezone merge into one, and the rest of the gaps are unchanged.
+    """
+    n = len(sorted_tzs)
+    i = bisect_left(sorted_tzs, tz)
+    first = sorted_tzs[1] if i == 0 else sorted_tzs[0]
+    last = sorted_tzs[-2] if i == n-1 else sorted_tzs[-1]
+    max_gap = first - last + 24
+    if 0 < i < n-1 and sorted_tzs[i+1] - sorted_tzs[i-1] > max_gap:
+        max_gap = sorted_tzs[i+1] - sorted_tzs[i-1]
+    for j in range(1, n):
+        if j != i and j-1 != i and sorted_tzs[j] - sorted_tzs[j-1] > max_gap:
+            max_gap = sorted_tzs[j] - sorted_tzs[j-1]
+    return 24 - max_gap
 
 
 def tz_dist(x: float, y: float) -> float:
@@ -45,19 +103,33 @@ def tz_dist(x: float, y: float) -> float:
     Distance between two timezones.
     Special case of tz_span implemented to be faster.
     """
-    return min(abs(x-y), 24-abs(x-y))
+    d = (x-y) % 24
+    return d if d <= 12 else 24 - d
 
 
-def exp_improvement(candidate: Person, team: list[Person], global_avg: float) -> float:
+def exp_improvement(candidate: Person, team_id: int, global_avg: float) -> float:
     """
     Measure how much adding a person to a team would take its avg experience level closer to the global avg.
     """
-    team_exp = sum(p.exp for p in team)
-    before = team_exp/len(team) - global_avg
-    after = (team_exp+candidate.exp)/(len(team)+1) - global_avg
+    team_exp = TEAM_EXP_SUMS[team_id]
+    team_size = len(TEAMS[team_id])
+    before = team_exp/team_size - global_avg
+    after = (team_exp+candidate.exp)/(team_size+1) - global_avg
     return before**2 - after**2
 
 
+def add_to_team(team_id: int, person: Person):
+    TEAMS[team_id].append(person)
+    insort(TEAM_TZS[team_id], person.tz)
+    TEAM_EXP_SUMS[team_id] += person.exp
+
+
+def remove_from_team(team_id: int, person: Person):
+    TEAMS[team_id].remove(person)
+    TEAM_TZS[team_id].remove(person.tz)
+    TEAM_EXP_SUMS[team_id] -= person.exp
+
+
 def form_teams():
     """
     Pick leaders and form teams around them.
@@ -74,6 +146,14 @@ def form_teams():
     if (len(potential_leaders)+1) * TARGET_TEAM_SIZE <= len(PEOPLE):
         raise Exception("Not enough leaders for the target team size.")
     leaders: set[Person] = set()
+    # Within a timezone, the best leader is always the one with the highest (lead_priority, exp),
+    # so each pick only needs to compare the best remaining leader from each timezone.
+    # Each group is sorted worst to best, and the original set order breaks ties like max() would.
+    leaders_by_tz: dict[float, list[tuple[int, int, int, Person]]] = {}
+    for order, pl in enumerate(potential_leaders):
+        leaders_by_tz.setdefault(pl.tz, []).append((pl.lead_priority, pl.exp, -order, pl))
+    for group in leaders_by_tz.values():
+        group.sort()
     # Order by TZ, starting in the middle of the Pacific as a de facto start/end point,
     # then use every [TEAM_SIZE]th person's TZ as representative.
     # Easy way to get a leader distribution that roughly matches the overall distribution
@@ -81,22 +161,25 @@ def form_teams():
     PEOPLE.sort(key=lambda p: (p.tz-12)%24)
     for person in PEOPLE[TARGET_TEAM_SIZE//2::TARGET_TEAM_SIZE]:
         target_tz = person.tz
-        best_leader_match = max(
-            potential_leaders,
-            key=lambda pl: (
+        best_tz = max(
+            leaders_by_tz,
+            key=lambda tz: (
                 # treat adjacent timezones the same as distance 0
                 # we don't want to compromise on having good leaders unless it really stretches the timezone range
-                -max(TARGET_TZ_SPAN/2, tz_dist(pl.tz, target_tz)),
-                pl.lead_priority,
-                pl.exp,
+                -max(TARGET_TZ_SPAN/2, tz_dist(tz, target_tz)),
+                *leaders_by_tz[tz][-1][:3],
             )
         )
+        *_, best_leader_match = leaders_by_tz[best_tz].pop()
+        if not leaders_by_tz[best_tz]:
+            del leaders_by_tz[best_tz]
         leaders.add(best_leader_match)
-        potential_leaders.remove(best_leader_match)
 
     # Form a team around each leader
-    global TEAMS, UNASSIGNED
+    global TEAMS, TEAM_TZS, TEAM_EXP_SUMS, UNASSIGNED
     TEAMS = [[leader] for leader in leaders]
+    TEAM_TZS = [[team[0].tz] for team in TEAMS]
+    TEAM_EXP_SUMS = [team[0].exp for team in TEAMS]
     UNASSIGNED = {p for p in PEOPLE if p not in leaders}
 
     logging.info(f"Initialized {len(TEAMS)} teams")
@@ -104,20 +187,25 @@ def form_teams():
 
     # Rotate through teams and have them draft people
     logging.info("Phase 1: teams draft good fits")
-    for first_team in TEAMS*(TARGET_TEAM_SIZE-1):
-        nearby_unassigned = [p for p in UNASSIGNED if MAX_TZ_SPAN >= tz_span(*[p.tz for p in first_team], p.tz)]
+    for team_id in [*range(len(TEAMS))] * (TARGET_TEAM_SIZE-1):
+        if not UNASSIGNED:
+            break
+        first_team_tzs = TEAM_TZS[team_id]
+        # Treat timezone spans within the target span the same
+        # to allow the experience to matter as long as they're within a reasonable timezone window.
+        nearby_unassigned = [
+            (max(TARGET_TZ_SPAN, span), p) for p in UNASSIGNED
+            if MAX_TZ_SPAN >= (span := tz_span_with(first_team_tzs, p.tz))
+        ]
         if nearby_unassigned:
             # Else the team will be short and there will be an extra leftover to be resolved with swaps.
+            # Only the people in the best timezone tier are in the running, so only score their experience.
+            best_tier = min(tier for tier, _ in nearby_unassigned)
             best_match = max(
-                nearby_unassigned,
-                key=lambda person: (
-                    # Treat timezone spans within the target span the same
-                    # to allow the experience to matter as long as they're within a reasonable timezone window.
-                    -max(TARGET_TZ_SPAN, tz_span(*[p.tz for p in first_team], person.tz)),
-                    exp_improvement(person, first_team, EXP_AVG),
-                )
+                (p for tier, p in nearby_unassigned if tier == best_tier),
+                key=lambda person: exp_improvement(person, team_id, EXP_AVG),
             )
-            first_team.append(best_match)
+            add_to_team(team_id, best_match)
             UNASSIGNED.remove(best_match)
     
     logging.info(f"{sum(len(team) for team in TEAMS)} people assigned to teams")
@@ -126,20 +214,19 @@ def form_teams():
     # Assign leftovers to form teams of [TARGET_TEAM_SIZE]+1
     logging.info(f"Phase 2: assigning leftovers")
     for person in UNASSIGNED.copy():
-        available_teams = [
-            team for team in TEAMS
-            if len(team) <= TARGET_TEAM_SIZE
-            and tz_span(*[p.tz for p in team], person.tz) <= MAX_TZ_SPAN
-        ]
-        if available_teams:
-            best_team_match = max(
-                available_teams,
-                key=lambda team: (
-                    -max(TARGET_TZ_SPAN, tz_span(*[p.tz for p in team], person.tz)),
-                    exp_improvement(person, team, EXP_AVG),
-                ),
-            )
-            best_team_match.append(person)
+        # Track the best available team in a single pass rather than collecting them all first.
+        best_team_id, best_key = None, None
+        for team_id, team in enumerate(TEAMS):
+            if len(team) > TARGET_TEAM_SIZE:
+                continue
+            span = tz_span_with(TEAM_TZS[team_id], person.tz)
+            if span > MAX_TZ_SPAN:
+                continue
+            key = (-max(TARGET_TZ_SPAN, span), exp_improvement(person, team_id, EXP_AVG))
+            if best_key is None or key > best_key:
+                best_team_id, best_key = team_id, key
+        if best_team_id is not None:
+            add_to_team(best_team_id, person)
             UNASSIGNED.remove(person)
     
     logging.info(f"{sum(len(team) for team in TEAMS)} people assigned to teams")
@@ -152,7 +239,7 @@ def form_teams():
         for _ in range(TARGET_TEAM_SIZE - len(team)):
             swap_chain = find_swap(
                 team,
-                {team_id},
+                1 << team_id,
                 search_depth=3,
                 skip_unassigned=True,
             )
@@ -160,16 +247,16 @@ def form_teams():
                 break
             swap_chain_string = "\n\t".join(str(person) for person in swap_chain)
             logging.debug(f"Executing swap chain:\n\t{swap_chain_string}")
-            target_team = team
+            target_team_id = team_id
             for person, from_team_id in swap_chain:
-                target_team.append(person)
+                add_to_team(target_team_id, person)
                 if from_team_id is None:
                     # If it is None, the person was unassigned and they should be the last one in the chain
                     UNASSIGNED.remove(person)
-                    target_team = None  # Break things if something weird happens
+                    target_team_id = None  # Break things if something weird happens
                 else:
-                    TEAMS[from_team_id].remove(person)
-                    target_team = TEAMS[from_team_id]
+                    remove_from_team(from_team_id, person)
+                    target_team_id = from_team_id
 
     # Replace leader if there is a strictly better one on the same team (should be rare)
     for team in TEAMS:
@@ -184,7 +271,7 @@ def form_teams():
 
 def find_swap(
     target_team: list[Person],
-    involved_teams: set[int],
+    involved_teams: int,
     search_depth: int = 1,
     skip_unassigned: bool = False,
 ) -> tuple[tuple[Person, int], ...]:
@@ -192,31 +279,46 @@ def find_swap(
     Find a person that would fit on target_team.
     If needed, recurse to find a replacement for the team they came from.
     Returns a chain of people to get reassigned.
+    involved_teams is a bitmask of team ids, which is cheaper to extend on each recursion than a set.
     """
+    target_team_tzs = tuple(sorted(p.tz for p in target_team))
+    # statistics.mean does exact fractional arithmetic, which is far too slow for this loop.
+    target_team_exp = sum(p.exp for p in target_team)
+    new_target_team_size = len(target_team) + 1
+    # The experience checks are O(1), so they go first to skip most of the timezone span checks.
+    # Every team's span is kept within MAX_TZ_SPAN, so by the triangle inequality no one on a team
+    # whose first timezone is more than twice that far from target_team's could fit on target_team.
+    target_team_anchor_tz = target_team_tzs[0]
+
     # First check if any unassigned people fit on the target team.
     if not skip_unassigned:
         for person in UNASSIGNED:
-            target_team_tz_span = tz_span(*[p.tz for p in target_team], person.tz)
-            target_team_exp_avg = mean([p.exp for p in target_team] + [person.exp])
-            if target_team_tz_span <= MAX_TZ_SPAN and abs(EXP_AVG - target_team_exp_avg) <= TARGET_EXP_RADIUS:
+            target_team_exp_avg = (target_team_exp + person.exp) / new_target_team_size
+            if (
+                abs(EXP_AVG - target_team_exp_avg) <= TARGET_EXP_RADIUS
+                and tz_span_with_cached(target_team_tzs, person.tz) <= MAX_TZ_SPAN
+            ):
                 return ((person, None),)
 
     # Then check for people from other teams that are large enough not to require replacement.
     for from_team_id, from_team in enumerate(TEAMS):
-        if from_team_id in involved_teams or len(from_team) < TARGET_TEAM_SIZE + 1:
+        if involved_teams >> from_team_id & 1 or len(from_team) < TARGET_TEAM_SIZE + 1:
             continue
+        from_team_tzs = TEAM_TZS[from_team_id]
+        if tz_dist(target_team_anchor_tz, from_team_tzs[0]) > 2*MAX_TZ_SPAN:
+            continue
+        from_team_exp = TEAM_EXP_SUMS[from_team_id]
+        new_from_team_size = len(from_team) - 1
         # Don't want to swap leaders, so skip them.
         for person in from_team[1:]:
-            target_team_tz_span = tz_span(*[p.tz for p in target_team], person.tz)
-            from_team_tz_span = tz_span(*[p.tz for p in from_team if p != person])
-            target_team_exp_avg = mean([p.exp for p in target_team] + [person.exp])
-            from_team_exp_avg = mean([p.exp for p in from_team if p != person])
-            if all((
-                target_team_tz_span <= MAX_TZ_SPAN,
-                from_team_tz_span <= MAX_TZ_SPAN,
-                abs(EXP_AVG - target_team_exp_avg) <= TARGET_EXP_RADIUS,
-                abs(EXP_AVG - from_team_exp_avg) <= TARGET_EXP_RADIUS,
-            )):
+            target_team_exp_avg = (target_team_exp + person.exp) / new_target_team_size
+            from_team_exp_avg = (from_team_exp - person.exp) / new_from_team_size
+            if (
+                abs(EXP_AVG - target_team_exp_avg) <= TARGET_EXP_RADIUS
+                and abs(EXP_AVG - from_team_exp_avg) <= TARGET_EXP_RADIUS
+                and tz_span_with_cached(target_team_tzs, person.tz) <= MAX_TZ_SPAN
+                and tz_span_without(from_team_tzs, person.tz) <= MAX_TZ_SPAN
+            ):
                 return ((person, from_team_id),)
 
     if search_depth <= 1:
@@ -224,17 +326,21 @@ def find_swap(
     
     # Finally check for swaps that require a replacement.
     for from_team_id, from_team in enumerate(TEAMS):
-        if from_team_id in involved_teams or len(from_team) < TARGET_TEAM_SIZE:
+        if involved_teams >> from_team_id & 1 or len(from_team) < TARGET_TEAM_SIZE:
+            continue
+        if tz_dist(target_team_anchor_tz, TEAM_TZS[from_team_id][0]) > 2*MAX_TZ_SPAN:
             continue
         for person in from_team[1:]:
-            target_team_tz_span = tz_span(*[p.tz for p in target_team], person.tz)
-            target_team_exp_avg = mean([p.exp for p in target_team] + [person.exp])
-            if target_team_tz_span <= MAX_TZ_SPAN and abs(EXP_AVG - target_team_exp_avg) <= TARGET_EXP_RADIUS:
+            target_team_exp_avg = (target_team_exp + person.exp) / new_target_team_size
+            if (
+                abs(EXP_AVG - target_team_exp_avg) <= TARGET_EXP_RADIUS
+                and tz_span_with_cached(target_team_tzs, person.tz) <= MAX_TZ_SPAN
+            ):
                 # This would be a good swap for target_team, but first need to find a replacement for from_team
                 # logging.debug(f"Looking for a replacement for {person.id}  (depth={search_depth})")
                 swap = find_swap(
-                    [p for p in from_team if p!=person],
-                    {*involved_teams, from_team_id},
+                    [p for p in from_team if p is not person],
+                    involved_teams | 1 << from_team_id,
                     search_depth - 1,
                 )
                 if swap is not None:
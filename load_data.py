@@ -1,11 +1,14 @@
 import csv
 import json
 import logging
+import orjson
 import os
 import re
 import requests
 from collections import Counter
+from operator import itemgetter
 from pathlib import Path
+from typing import Iterator, Optional
 
 from dotenv import load_dotenv
 
@@ -32,6 +35,10 @@ BLACKLIST_HEADERS = ["discord_id", "discord_username", "github_username"]
 FINAL_PARTICIPANTS_HEADERS = ["discord_id", "discord_username", "github_username", "timezone", "python_experience", "git_experience", "age", "codejam_experience", "team_leader", "lead_priority"]
 # Manual upsertion headers should match final participants headers
 
+# Form fields matching the order of QUALIFIED_HEADERS, split between the submission's user and response.
+QUALIFIED_USER_FIELDS = itemgetter("id", "username")
+QUALIFIED_RESPONSE_FIELDS = itemgetter("age-range", "timezone", "python-experience", "git-experience", "team-leader", "code-jam-experience")
+
 # These are the literal form values. If the answers on the form are changed, these also need to be changed.
 # The order of these matters.
 PYTHON_EXPERIENCE = (
@@ -46,9 +53,14 @@ GIT_EXPERIENCE = (
     "I'm pretty familiar with Git and use it regularly",
     "I can cherry-pick a remote branch using the disturbance ripples of butterflies",
 )
+# Lookup from form answer to experience level, to avoid scanning the tuples for every submission.
+PYTHON_EXPERIENCE_LEVEL = {answer: level for level, answer in enumerate(PYTHON_EXPERIENCE)}
+GIT_EXPERIENCE_LEVEL = {answer: level for level, answer in enumerate(GIT_EXPERIENCE)}
 
 
 class Person:
+    __slots__ = ("id", "tz", "exp", "lead_priority", "name", "gh_name")
+
     def __init__(self, id: int, tz: float, exp: int, lead_priority: int, *, name: str = "", gh_name: str = ""):
         self.id = id
         self.tz = tz % 24
@@ -68,49 +80,80 @@ class Person:
 
 
 TZ_PATTERN = re.compile(r"([+-]?)(\d{1,2})(?::(\d{2}))?$")
-def parse_tz(raw_string: str) -> float:
+TZ_SIGN = {"": 1, "+": 1, "-": -1}
+def parse_tz(raw_string: str) -> Optional[float]:
     """
     Input: timezone string e.g. "-12:30"
-    Output: timezone float normalized to 0-24 e.g. 11.5
+    Output: timezone float normalized to 0-24 e.g. 11.5, or None if it could not be parsed
     """
-    m = re.match(TZ_PATTERN, raw_string.strip())
+    m = TZ_PATTERN.match(raw_string.strip())
     if m is None:
-        raise Exception(f"Could not parse {raw_string} as a timezone")
-    mult = 1 if m.group(1) in ("", "+") else -1
+        return None
+    mult = TZ_SIGN[m.group(1)]
     hr = int(m.group(2))
-    if m.group(3):
-        hr += int(m.group(3))/60
+    if minutes := m.group(3):
+        hr += int(minutes)/60
     return (hr * mult) % 24
 
 
+def read_columns(file, *columns: str) -> Iterator[list[str]]:
+    """
+    Yield only the given columns of each row of a CSV file, in the given order.
+    Cheaper than csv.DictReader, which builds a dict out of every row.
+    """
+    reader = csv.reader(file)
+    header = next(reader, None)
+    if header is None:
+        return
+    indices = [header.index(column) for column in columns]
+    for row in reader:
+        # Like DictReader, skip blank lines.
+        if row:
+            yield [row[i] for i in indices]
+
+
+def qualified_rows(submissions: list[dict]) -> Iterator[tuple]:
+    """
+    Pull the qualified CSV columns out of each qualifier form submission, in QUALIFIED_HEADERS order.
+    """
+    try:
+        for submission in submissions:
+            yield QUALIFIED_USER_FIELDS(submission["user"]) + QUALIFIED_RESPONSE_FIELDS(submission["response"])
+    except Exception as err:
+        logging.exception(json.dumps(submission, indent=2))
+        raise err
+
+
+def confirmed_rows(submissions: list[dict]) -> Iterator[tuple]:
+    """
+    Pull the confirmed CSV columns out of each confirmation form submission that confirmed participation,
+    in CONFIRMED_HEADERS order.
+    """
+    try:
+        for submission in submissions:
+            if submission["response"]["participation"] != "Yes":
+                continue
+            yield submission["user"]["id"], submission["response"]["github"]
+    except Exception as err:
+        logging.exception(json.dumps(submission, indent=2))
+        raise err
+
+
 def write_qualified_csv():
     """
     Record raw responses from qualifier form.
-    Does not filter to only participants who have confirmed, and may include multiple records per person.
+    Does not filter to only participants who have confirmed, but only keeps the latest response per person.
     """
     response = requests.get(QUALIFIER_FORM_URL, cookies={"token": TOKEN})
     response.raise_for_status()
-    submissions = response.json()
+    submissions = orjson.loads(response.content)
+    # Latest submission for each Discord ID will be used.
+    latest = {person_info[0]: person_info for person_info in qualified_rows(submissions)}
     with open(QUALIFIED_CSV, "w", encoding="utf-8") as file:
-        writer = csv.DictWriter(file, lineterminator="\n", fieldnames=QUALIFIED_HEADERS)
-        writer.writeheader()
-        for submission in submissions:
-            try:
-                person_info = {
-                    "discord_id": submission["user"]["id"],
-                    "discord_username": submission["user"]["username"],
-                    "age": submission["response"]["age-range"],
-                    "timezone": submission["response"]["timezone"],
-                    "python_experience": submission["response"]["python-experience"],
-                    "git_experience": submission["response"]["git-experience"],
-                    "team_leader": submission["response"]["team-leader"],
-                    "codejam_experience": submission["response"]["code-jam-experience"],
-                }
-                writer.writerow(person_info)
-            except Exception as err:
-                logging.exception(json.dumps(submission, indent=2))
-                raise err
-    logging.info(f"Retrieved {len(submissions)} qualifier responses")
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(QUALIFIED_HEADERS)
+        writer.writerows(latest.values())
+    logging.info(f"Retrieved {len(submissions)} qualifier responses from {len(latest)} people")
 
 
 def write_confirmed_csv():
@@ -119,24 +162,13 @@ def write_confirmed_csv():
     """
     response = requests.get(CONFIRMATION_FORM_URL, cookies={"token": TOKEN})
     response.raise_for_status()
-    submissions = response.json()
-    participation_count = 0
+    submissions = orjson.loads(response.content)
+    confirmed = list(confirmed_rows(submissions))
     with open(CONFIRMED_CSV, "w") as file:
-        writer = csv.DictWriter(file, lineterminator="\n", fieldnames=CONFIRMED_HEADERS)
-        writer.writeheader()
-        try:
-            for submission in submissions:
-                if submission["response"]["participation"] != "Yes":
-                    continue
-                participation_count += 1
-                writer.writerow({
-                    "discord_id": submission["user"]["id"],
-                    "github_username": submission["response"]["github"],
-                })
-        except Exception as err:
-            logging.exception(json.dumps(submission, indent=2))
-            raise err
-    logging.info(f"Retrieved {len(submissions)} confirmation responses, {participation_count} confirmed")
+        writer = csv.writer(file, lineterminator="\n")
+        writer.writerow(CONFIRMED_HEADERS)
+        writer.writerows(confirmed)
+    logging.info(f"Retrieved {len(submissions)} confirmation responses, {len(confirmed)} confirmed")
 
 
 def write_final_participants_csv():
@@ -145,12 +177,12 @@ def write_final_participants_csv():
     Allows manual review and vetting for leaders before starting the team-forming.
     """
     with open(BLACKLIST_CSV, encoding="utf-8") as file:
-        blacklist = {line["discord_id"] for line in csv.DictReader(file)}
+        blacklist = {int(d_id) for d_id, in read_columns(file, "discord_id")}
     logging.info(f"Loaded {len(blacklist)} blacklisted people")
     
     with open(CONFIRMED_CSV, encoding="utf-8") as file:
         # Latest submission for each Discord ID will be used.
-        confirmed = {int(line["discord_id"]): line for line in csv.DictReader(file)}
+        confirmed = {int(d_id): gh_name for d_id, gh_name in read_columns(file, "discord_id", "github_username")}
     logging.info(f"Loaded {len(confirmed)} confirmed people")
 
     with open(QUALIFIED_CSV, encoding="utf-8") as file:
@@ -160,10 +192,11 @@ def write_final_participants_csv():
             if (d_id in blacklist) or (d_id not in confirmed):
                 continue
             py_exp = person["python_experience"].replace("have possible worked", "have possibly worked") # Typo fix in 2023; if it is not 2023 you can delete this
-            person["python_experience"] = PYTHON_EXPERIENCE.index(py_exp)
-            person["git_experience"] = GIT_EXPERIENCE.index(person["git_experience"])
+            person["python_experience"] = PYTHON_EXPERIENCE_LEVEL[py_exp]
+            person["git_experience"] = GIT_EXPERIENCE_LEVEL[person["git_experience"]]
             # Latest submission for each Discord ID will be used.
-            qualified[d_id] = {**person, "github_username": confirmed[d_id]["github_username"]}
+            person["github_username"] = confirmed[d_id]
+            qualified[d_id] = person
     logging.info(f"Loaded {len(qualified)} qualified people")
 
     try:
@@ -181,15 +214,10 @@ def write_final_participants_csv():
         pass
 
     with open(FINAL_PARTICIPANTS_CSV, "w") as file:
-        writer = csv.DictWriter(file, lineterminator="\n", fieldnames=FINAL_PARTICIPANTS_HEADERS)
+        # Columns that are not in the final participants CSV are dropped by the writer.
+        writer = csv.DictWriter(file, lineterminator="\n", fieldnames=FINAL_PARTICIPANTS_HEADERS, extrasaction="ignore")
         writer.writeheader()
-        for d_id, person_info in qualified.items():
-            person_info = {
-                key: val
-                for key,val in person_info.items()
-                if key in FINAL_PARTICIPANTS_HEADERS
-            }
-            writer.writerow(person_info)
+        writer.writerows(qualified.values())
     
 
 def load_final_participants() -> list[Person]:
@@ -199,30 +227,44 @@ def load_final_participants() -> list[Person]:
     """
     with open(BLACKLIST_CSV, encoding="utf-8" ) as file:
         # These should already be filtered out, but this allows adding to the blacklist after manual vetting.
-        blacklist = [int(line["discord_id"]) for line in csv.DictReader(file)]
+        blacklist = {int(d_id) for d_id, in read_columns(file, "discord_id")}
 
     people: list[Person] = []
+    columns = ("discord_id", "discord_username", "github_username", "timezone", "python_experience", "git_experience", "lead_priority")
+    # Rows with unparseable timezones are collected so they can all be fixed after one run.
+    bad_timezones: list[list[str]] = []
     with open(FINAL_PARTICIPANTS_CSV, encoding="utf-8") as file:
-        for person_info in csv.DictReader(file):
+        for person_info in read_columns(file, *columns):
             try:
-                d_id = int(person_info["discord_id"])
+                d_id, name, gh_name, raw_tz, py_exp, git_exp, lead_priority = person_info
+                d_id = int(d_id)
                 if d_id in blacklist:
                     continue
-                name = person_info["discord_username"]
-                gh_name = person_info["github_username"]
-                tz = parse_tz(person_info["timezone"])
-                exp = int(person_info["python_experience"]) + int(person_info["git_experience"])
-                lead_priority = int(person_info["lead_priority"])
+                tz = parse_tz(raw_tz)
+                if tz is None:
+                    bad_timezones.append(person_info)
+                    continue
+                exp = int(py_exp) + int(git_exp)
+                lead_priority = int(lead_priority)
                 people.append(Person(d_id, tz, exp, lead_priority, name=name, gh_name=gh_name))
             except Exception as err:
-                logging.debug(json.dumps(person_info, indent=2))
+                logging.debug(json.dumps(dict(zip(columns, person_info)), indent=2))
                 raise err
+    if bad_timezones:
+        for person_info in bad_timezones:
+            logging.error(f"Could not parse {person_info[3]} as a timezone for {person_info[0]}")
+        raise Exception(f"Could not parse the timezones of {len(bad_timezones)} participants")
 
     # Sanity checks
     logging.info(f"Loaded info for {len(people)} participants")
-    logging.info(f"Timezones: {sorted(Counter(p.tz for p in people).items())}")
-    logging.info(f"Exp: {sorted(Counter(p.exp for p in people).items())}")
-    logging.info(f"Leads: {sorted(Counter(p.lead_priority for p in people).items())}")
+    tz_counts, exp_counts, lead_counts = Counter(), Counter(), Counter()
+    for p in people:
+        tz_counts[p.tz] += 1
+        exp_counts[p.exp] += 1
+        lead_counts[p.lead_priority] += 1
+    logging.info(f"Timezones: {sorted(tz_counts.items())}")
+    logging.info(f"Exp: {sorted(exp_counts.items())}")
+    logging.info(f"Leads: {sorted(lead_counts.items())}")
     return people
 
 if __name__ == "__main__":